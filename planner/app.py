@@ -1,49 +1,119 @@
 # planner/app.py
+import asyncio
+import hashlib
+import io
 import os
-import json
+import re
 import datetime
-from typing import Any, Dict, List, Optional
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 load_dotenv()  # load repo-root .env
 
-import boto3
+import aioboto3
+import fastjsonschema
+from cachetools import TTLCache
+import msgspec
+import orjson
 from botocore.config import Config
-from boto3.session import Session
+from botocore.exceptions import ClientError
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
 
 # ====== Config (EU) ======
 MODEL_ID = os.getenv("BEDROCK_MODEL_ID", "eu.amazon.nova-pro-v1:0")
 REGION   = os.getenv("AWS_REGION", "eu-north-1")
+# Bedrock inference profile: "optimized" (latency-optimized) or "standard"; empty disables it
+PERF_LATENCY = os.getenv("BEDROCK_LATENCY", "optimized")
+# Mark the static system prompt (and tool schema, where supported) as a prompt-cache checkpoint
+PROMPT_CACHE = os.getenv("BEDROCK_PROMPT_CACHE", "1") == "1"
+# Only these model families accept cachePoint blocks; elsewhere Bedrock rejects the request.
+# Checkpoints below the model's minimum prefix size (e.g. ~1K tokens on Nova) are simply not cached.
+_CACHE_SYSTEM = PROMPT_CACHE and ("amazon.nova" in MODEL_ID or "anthropic." in MODEL_ID)
+# Nova caches system/messages only; tool-schema checkpoints are an Anthropic-model feature
+_CACHE_TOOLS = PROMPT_CACHE and "anthropic." in MODEL_ID
+_CACHE_POINT = {"cachePoint": {"type": "default"}}
+# Character budgets for the project context sent with each prompt
+TREE_BUDGET     = int(os.getenv("PLANNER_TREE_CHARS", "8000"))
+SNIPPET_MAX     = 2000
+# Token budget for all snippets together (estimated at ~4 chars per token)
+SNIPPETS_TOKENS = int(os.getenv("PLANNER_SNIPPET_TOKENS", "3000"))
+# Finished plans are reused for identical requests within this window (seconds)
+PLAN_CACHE_TTL  = int(os.getenv("PLANNER_CACHE_TTL", "120"))
+PLAN_CACHE_SIZE = int(os.getenv("PLANNER_CACHE_SIZE", "512"))
+# Dev-only POST /cache/clear (unauthenticated), off unless PLANNER_CACHE_CLEAR=1
+CACHE_CLEAR_ROUTE = os.getenv("PLANNER_CACHE_CLEAR") == "1"
+# Per-client limit on Bedrock-backed calls. With the default memory:// storage it is enforced
+# per worker process (WORKERS=4 allows 4x this); point the storage at redis:// to share it.
+RATE_LIMIT         = os.getenv("PLANNER_RATE_LIMIT", "30/minute")
+RATE_LIMIT_STORAGE = os.getenv("PLANNER_RATE_LIMIT_STORAGE", "memory://")
 
-# Validate credentials early with a friendly error
-_session = Session()
-if not _session.get_credentials():
-    raise RuntimeError(
-        "No AWS credentials detected. Provide one of:\n"
-        "- AWS_PROFILE in .env (recommended), configured via `aws configure` or `aws sso login`\n"
-        "- or AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY (and AWS_SESSION_TOKEN if temporary) in env/.env\n"
-    )
-
-# Bedrock runtime client
-brt = boto3.client(
-    "bedrock-runtime",
-    region_name=REGION,
-    config=Config(read_timeout=60, connect_timeout=10, retries={"max_attempts": 2}),
+# Bedrock runtime client (aioboto3): created lazily in the lifespan handler, not at import,
+# and kept on app.state.brt for the life of the process
+_aio_session = aioboto3.Session()
+_BEDROCK_CONFIG = Config(
+    read_timeout=60,
+    connect_timeout=3,
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={"max_attempts": 2, "mode": "adaptive"},
+    # Requests are built from the static _SYSTEM_BLOCK/_TOOL_CONFIG below; skip botocore's
+    # per-call walk of the nested tool schema (Bedrock still validates server-side).
+    parameter_validation=False,
 )
 
-# Helpful diagnostics on startup
-try:
-    who = boto3.client("sts").get_caller_identity().get("Arn")
-    print("👤 AWS Identity:", who)
-except Exception as e:
-    print("⚠️ Could not fetch STS caller identity:", e)
+# Helpful diagnostics on startup (STS identity is resolved in the lifespan handler)
 print("🕒 Local UTC:", datetime.datetime.utcnow().isoformat() + "Z")
-print("🌍 Region:", REGION, "| 🧠 Model:", MODEL_ID)
+print("🌍 Region:", REGION, "| 🧠 Model:", MODEL_ID, "| ⚡ Latency:", PERF_LATENCY or "default")
+
+class ORJSONResponse(JSONResponse):
+    media_type = "application/json"
 
-app = FastAPI(title="Nova Pro Planner (EU)")
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+async def _identity() -> Optional[str]:
+    try:
+        async with _aio_session.client("sts", region_name=REGION) as sts:
+            who = (await sts.get_caller_identity()).get("Arn")
+        print("👤 AWS Identity:", who)
+        return who
+    except Exception as e:
+        print("⚠️ Could not fetch STS caller identity:", e)
+        return None
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Validate credentials early with a friendly error
+    if not await _aio_session.get_credentials():
+        raise RuntimeError(
+            "No AWS credentials detected. Provide one of:\n"
+            "- AWS_PROFILE in .env (recommended), configured via `aws configure` or `aws sso login`\n"
+            "- or AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY (and AWS_SESSION_TOKEN if temporary) in env/.env\n"
+        )
+    async with AsyncExitStack() as clients:
+        app.state.brt = await clients.enter_async_context(
+            _aio_session.client("bedrock-runtime", region_name=REGION, config=_BEDROCK_CONFIG)
+        )
+        # Skip the STS roundtrip on serverless cold starts
+        app.state.arn = None if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else await _identity()
+        yield
+
+app = FastAPI(title="Nova Pro Planner (EU)", default_response_class=ORJSONResponse, lifespan=_lifespan)
+
+# Keyed on the client address only: client-supplied headers would let callers mint new buckets
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Plans carry whole files. Starlette >= 0.46 (pinned in requirements.txt) leaves
+# text/event-stream uncompressed, so SSE still flushes per event.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 SYSTEM_PROMPT = """
 You are a codegen agent for a Next.js (App Router + TypeScript) project.
@@ -84,7 +154,8 @@ EMIT_PLAN_TOOL = {
                                 "properties": {
                                     "type": {"type": "string", "const": "update_file"},
                                     "path": {"type": "string"},
-                                    "contents": {"type": "string"},
+                                    # forbid empty update_file
+                                    "contents": {"type": "string", "minLength": 1},
                                 },
                                 "required": ["type", "path", "contents"],
                                 "additionalProperties": False,
@@ -117,61 +188,283 @@ EMIT_PLAN_TOOL = {
     },
 }
 
-# ====== FastAPI models ======
-class ContextModel(BaseModel):
-    manifest: Dict[str, Any] = Field(default_factory=dict)
-    tree: List[str] = Field(default_factory=list)
-    snippets: Dict[str, str] = Field(default_factory=dict)
+# ====== Static request parts (built once at import) ======
+_DEFAULT_MANIFEST = {"framework": "next", "router": "app", "typescript": True, "tailwind": True}
+_DEFAULT_MANIFEST_JSON = orjson.dumps(_DEFAULT_MANIFEST, option=orjson.OPT_INDENT_2).decode()
+# The cache checkpoints sit after the static prefix so only the user turn is prefilled.
+_SYSTEM_BLOCK = [{"text": SYSTEM_PROMPT}] + ([_CACHE_POINT] if _CACHE_SYSTEM else [])
+_TOOL_CONFIG = {"tools": [{"toolSpec": EMIT_PLAN_TOOL}] + ([_CACHE_POINT] if _CACHE_TOOLS else [])}
+# Same schema the model is given, compiled once to validate what it sends back
+_validate_plan = fastjsonschema.compile(EMIT_PLAN_TOOL["inputSchema"]["json"])
+
+# ====== Request models (msgspec: decoded straight from the raw body) ======
+class ContextModel(msgspec.Struct):
+    manifest: Dict[str, Any] = msgspec.field(default_factory=dict)
+    tree: List[str] = msgspec.field(default_factory=list)
+    snippets: Dict[str, str] = msgspec.field(default_factory=dict)
 
-class InvokeBody(BaseModel):
+class InvokeBody(msgspec.Struct):
     prompt: str
     context: Optional[ContextModel] = None
 
 # ====== Helpers ======
-def _payload(prompt_text: str, ctx: ContextModel) -> str:
-    manifest = ctx.manifest or {"framework": "next", "router": "app", "typescript": True, "tailwind": True}
-    return (
-        "PROJECT_MANIFEST:\n" + json.dumps(manifest, indent=2) + "\n" +
-        "FILE_TREE (truncated):\n" + "\n".join(ctx.tree or []) + "\n" +
-        "SNIPPETS:\n" + "\n\n".join([f"{k}:\n{(v or '')[:2000]}" for k, v in (ctx.snippets or {}).items()]) +
-        "\n\nTASK:\n" + prompt_text
-    )
+# Cleared once Bedrock shows the model/region doesn't accept performanceConfig
+_perf_latency_ok = bool(PERF_LATENCY)
+
+async def _converse(req: Dict[str, Any], stream: bool = False) -> Dict[str, Any]:
+    """Call Converse (or ConverseStream) with the latency-optimized profile, retrying
+    once without it if the model/region rejects performanceConfig."""
+    global _perf_latency_ok
+    brt = app.state.brt
+    call = brt.converse_stream if stream else brt.converse
+    if not _perf_latency_ok:
+        return await call(**req)
+    try:
+        return await call(**req, performanceConfig={"latency": PERF_LATENCY})
+    except ClientError as e:
+        err = e.response.get("Error", {})
+        msg = (err.get("Message") or "").lower()
+        # Other validation failures (input size, cachePoint, schema) would fail again; surface them as-is
+        if err.get("Code") != "ValidationException" or not ("performanceconfig" in msg or "latency" in msg):
+            raise
+        print("⚠️ performanceConfig rejected, retrying without it:", e)
+        res = await call(**req)
+        # Only the field was at fault; stop sending it for the rest of the process
+        _perf_latency_ok = False
+        return res
+
+_WORD = re.compile(r"[a-z0-9_]{3,}")
+# Filler words that would otherwise count as relevance hits
+_STOPWORDS = frozenset(
+    "the and for with that this from into are was were will can should would could have has had "
+    "not but all any some make use add new please also then than when what which who how its our "
+    "your you they them their there here out about just like only more most very"
+    .split()
+)
 
-def _ask_bedrock_for_plan(prompt_text: str, ctx: ContextModel) -> Dict[str, Any]:
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _select_snippets(prompt_text: str, snippets: Dict[str, str]) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Keep the snippets most relevant to the prompt (shared words), greedily filling
+    SNIPPETS_TOKENS. Returns (kept, dropped names) and logs any drops server-side."""
+    words = set(_WORD.findall(prompt_text.lower())) - _STOPWORDS
+    scored = []
+    for i, (k, v) in enumerate(snippets.items()):
+        v = (v or "")[:SNIPPET_MAX]
+        hits = len(words.intersection(_WORD.findall(f"{k}\n{v}".lower())))
+        scored.append((-hits, i, k, v))
+    scored.sort()
+
+    kept, dropped, budget = [], [], SNIPPETS_TOKENS
+    for _, i, k, v in scored:
+        cost = _estimate_tokens(k) + _estimate_tokens(v)
+        if cost > budget:
+            dropped.append(k)
+            continue
+        budget -= cost
+        kept.append((i, k, v))
+    if dropped:
+        print(f"⚠️ Snippet budget ({SNIPPETS_TOKENS} tokens) exceeded; dropped:", ", ".join(dropped))
+    # Send the survivors in the caller's original order
+    return [(k, v) for _, k, v in sorted(kept)], dropped
+
+def _payload(prompt_text: str, ctx: ContextModel) -> Tuple[str, List[str]]:
+    """Build the user turn; tree and snippets are capped by their budgets so the
+    prompt stays bounded regardless of project size. Also returns the names of
+    snippets that did not fit, so callers can be told their context was trimmed."""
+    buf = io.StringIO()
+    buf.write("PROJECT_MANIFEST:\n")
+    buf.write(orjson.dumps(ctx.manifest, option=orjson.OPT_INDENT_2).decode() if ctx.manifest else _DEFAULT_MANIFEST_JSON)
+    buf.write("\nFILE_TREE (truncated):\n")
+    n = 0
+    for line in ctx.tree or []:
+        if n + len(line) > TREE_BUDGET:
+            buf.write("...\n")
+            break
+        buf.write(line)
+        buf.write("\n")
+        n += len(line) + 1
+    buf.write("SNIPPETS:\n")
+    kept, dropped = _select_snippets(prompt_text, ctx.snippets or {})
+    buf.write("\n\n".join(f"{k}:\n{v}" for k, v in kept))
+    buf.write("\n\nTASK:\n")
+    buf.write(prompt_text)
+    return buf.getvalue(), dropped
+
+def _plan_request(user_text: str) -> Dict[str, Any]:
     # ✅ For Nova Converse, put system prompt in top-level "system", not as a message.
-    req = {
+    return {
         "modelId": MODEL_ID,
-        "system": [
-            {"text": SYSTEM_PROMPT}
-        ],
+        "system": _SYSTEM_BLOCK,
         "messages": [
-            {"role": "user", "content": [{"text": _payload(prompt_text, ctx)}]}
+            {"role": "user", "content": [{"text": user_text}]}
         ],
-        "toolConfig": {"tools": [{"toolSpec": EMIT_PLAN_TOOL}]},
+        "toolConfig": _TOOL_CONFIG,
     }
 
-    res = brt.converse(**req)
+def _check_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return _validate_plan(plan)
+    except fastjsonschema.JsonSchemaValueException as e:
+        # anyOf hides which branch failed; name the common empty update_file case explicitly
+        for i, a in enumerate(plan.get("actions") or [] if isinstance(plan, dict) else []):
+            if isinstance(a, dict) and a.get("type") == "update_file" and not a.get("contents"):
+                raise RuntimeError(f"Invalid update_file at index {i}: missing contents") from e
+        raise RuntimeError(f"Invalid plan: {e.message}") from e
+
+# Identical plan requests in flight share one Bedrock call (keyed by the user turn;
+# system prompt and tools are static).
+_inflight: Dict[str, "asyncio.Task[Tuple[Dict[str, Any], Dict[str, Any]]]"] = {}
+_plan_cache: "TTLCache[str, Dict[str, Any]]" = TTLCache(maxsize=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL)
+
+def _request_key(user_text: str) -> str:
+    return hashlib.blake2b(user_text.encode(), digest_size=16).hexdigest()
+
+async def _ask_bedrock_for_plan(user_text: str) -> Tuple[Dict[str, Any], Dict[str, Any], bool]:
+    """Return (plan, usage, cached); usage carries cacheRead/cacheWriteInputTokens when prompt
+    caching applies, and is empty when the plan came from _plan_cache (no Bedrock call made)."""
+    key = _request_key(user_text)
+    hit = _plan_cache.get(key)
+    if hit is not None:
+        return hit, {}, True
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_converse_plan(user_text))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _settle(key, t))
+    # shield: one caller disconnecting must not cancel the call for the others
+    plan, usage = await asyncio.shield(task)
+    return plan, usage, False
+
+def _settle(key: str, task: "asyncio.Task[Tuple[Dict[str, Any], Dict[str, Any]]]") -> None:
+    _inflight.pop(key, None)
+    # Cache even if every caller has gone away; exception() also marks failures as retrieved.
+    if not task.cancelled() and task.exception() is None:
+        _plan_cache[key] = task.result()[0]
+
+async def _converse_plan(user_text: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    res = await _converse(_plan_request(user_text))
+    # Read the boto3 response dict in place; stop at the first toolUse block.
     msg = (res.get("output") or {}).get("message") or {}
-    blocks = [b for b in (msg.get("content") or []) if "toolUse" in b]
-    if not blocks:
+    tu = next((b["toolUse"] for b in (msg.get("content") or []) if "toolUse" in b), None)
+    if tu is None:
         raise RuntimeError("Model did not emit toolUse; check model access or tighten prompt.")
-    tu = blocks[0]["toolUse"]
     if tu.get("name") != "emit_plan":
         raise RuntimeError(f"Unexpected tool name: {tu.get('name')}")
-    plan = tu.get("input") or {}
+    return _check_plan(tu.get("input") or {}), res.get("usage") or {}
+
+def _sse(data: Dict[str, Any]) -> bytes:
+    # orjson already yields UTF-8 bytes; frame them without a decode/re-encode pass
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+async def _stream_plan(user_text: str, dropped: List[str]) -> AsyncIterator[bytes]:
+    """Yield SSE events: one {"delta": ...} per toolUse input fragment, then a final
+    {"done": true, "plan": ..., "usage": ..., "cached": ..., "dropped_snippets": [...]}
+    (or {"error": ...}). The plan JSON is only parsed and validated once the stream has ended."""
+    try:
+        key = _request_key(user_text)
+        hit = _plan_cache.get(key)
+        if hit is not None:
+            yield _sse({"done": True, "plan": hit, "usage": {}, "cached": True, "dropped_snippets": dropped})
+            return
+        res = await _converse(_plan_request(user_text), stream=True)
+        tool_index, tool_name, fragments, usage = None, None, [], {}
+        try:
+            async for event in res["stream"]:
+                if "contentBlockStart" in event:
+                    start = event["contentBlockStart"]
+                    tu = (start.get("start") or {}).get("toolUse")
+                    if tu and tool_index is None:
+                        tool_index, tool_name = start.get("contentBlockIndex"), tu.get("name")
+                elif "contentBlockDelta" in event:
+                    delta = event["contentBlockDelta"]
+                    if delta.get("contentBlockIndex") != tool_index:
+                        continue
+                    frag = ((delta.get("delta") or {}).get("toolUse") or {}).get("input") or ""
+                    if frag:
+                        fragments.append(frag)
+                        yield _sse({"delta": frag})
+                elif "metadata" in event:
+                    usage = event["metadata"].get("usage") or {}
+        finally:
+            # Release the pooled connection even if the SSE client disconnected mid-stream
+            res["stream"].close()
+        if tool_index is None:
+            raise RuntimeError("Model did not emit toolUse; check model access or tighten prompt.")
+        if tool_name != "emit_plan":
+            raise RuntimeError(f"Unexpected tool name: {tool_name}")
+        plan = _check_plan(orjson.loads("".join(fragments) or "{}"))
+        _plan_cache[key] = plan
+        yield _sse({"done": True, "plan": plan, "usage": usage, "cached": False, "dropped_snippets": dropped})
+    except Exception as e:
+        yield _sse({"error": str(e)})
 
-    # Guard: forbid empty update_file
-    for i, a in enumerate(plan.get("actions", [])):
-        if a.get("type") == "update_file" and not a.get("contents"):
-            raise RuntimeError(f"Invalid update_file at index {i}: missing contents")
-    return plan
+# ====== Routes ======
+@app.get("/health")
+async def health():
+    return {"ok": True, "model": MODEL_ID, "region": REGION, "arn": getattr(app.state, "arn", None)}
 
-# ====== Route ======
-@app.post("/invocations")
-def invocations(body: InvokeBody):
+if CACHE_CLEAR_ROUTE:
+    @app.post("/cache/clear")
+    async def cache_clear():
+        n = len(_plan_cache)
+        _plan_cache.clear()
+        return {"cleared": n}
+
+# The body is decoded by msgspec rather than FastAPI, so publish its schema to OpenAPI by hand
+(_INVOKE_SCHEMA,), _INVOKE_COMPONENTS = msgspec.json.schema_components(
+    [InvokeBody], ref_template="#/components/schemas/{name}"
+)
+_default_openapi = app.openapi
+
+def _openapi() -> Dict[str, Any]:
+    schema = _default_openapi()
+    schema.setdefault("components", {}).setdefault("schemas", {}).update(_INVOKE_COMPONENTS)
+    return schema
+
+app.openapi = _openapi
+
+@app.post(
+    "/invocations",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": _INVOKE_SCHEMA}}}},
+)
+@limiter.limit(RATE_LIMIT)
+async def invocations(request: Request):
+    try:
+        body = msgspec.json.decode(await request.body(), type=InvokeBody)
+    except msgspec.DecodeError as e:
+        # Same list-of-errors shape as FastAPI's 422s; msg is msgspec's text (it names the
+        # failing path, e.g. "at `$.prompt`"), and only the first error is reported.
+        raise HTTPException(status_code=422, detail=[{"type": "value_error", "loc": ["body"], "msg": str(e)}])
+    user_text, dropped = _payload(body.prompt, body.context or ContextModel())
+    # Clients that accept SSE get tool-use deltas as they arrive; others get the full plan as JSON.
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _stream_plan(user_text, dropped),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     try:
-        ctx = body.context or ContextModel()
-        plan = _ask_bedrock_for_plan(body.prompt, ctx)
-        return {"plan": plan}
+        plan, usage, cached = await _ask_bedrock_for_plan(user_text)
+        # Plans are already schema-validated; returning a Response skips FastAPI's
+        # jsonable_encoder walk over every action's file contents.
+        return ORJSONResponse({"plan": plan, "usage": usage, "cached": cached, "dropped_snippets": dropped})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+if __name__ == "__main__":
+    # Production entrypoint (`python -m planner.app` from the repo root); `npm run planner` is the dev server.
+    # loop/http stay on uvicorn's "auto": uvloop + httptools where uvicorn[standard] installed them,
+    # asyncio + h11 elsewhere (uvloop is not available on Windows or PyPy).
+    import uvicorn
+
+    uvicorn.run(
+        "planner.app:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8080")),
+        workers=int(os.getenv("WORKERS", "4")),
+        backlog=2048,
+        # Per-request access logging costs CPU on every call; ACCESS_LOG=1 re-enables it
+        access_log=os.getenv("ACCESS_LOG") == "1",
+    )